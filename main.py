@@ -2,23 +2,129 @@ from flask import Flask, request, jsonify, send_file, Response
 import os
 import subprocess
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import tempfile
 import uuid
 import shutil
+import hashlib
+import fcntl
+import threading
+import time
+import http.cookiejar
+from concurrent.futures import ThreadPoolExecutor
 
 app = Flask(__name__)
 
 # Create output directory
 OUTPUT_DIR = '/tmp/videos'
 os.makedirs(OUTPUT_DIR, exist_ok=True)
+OUTPUT_CACHE_MAX_BYTES = int(os.environ.get('OUTPUT_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+OUTPUT_PRUNE_INTERVAL = 300  # seconds
+
+# Opt-in: reuse a combined video when the same audio_url/video_url pair comes
+# back. Only safe when those URLs always point at the same bytes, a shared
+# link whose file gets overwritten would keep returning the old output.
+REUSE_OUTPUTS = os.environ.get('REUSE_OUTPUTS', '').lower() in ('1', 'true', 'yes')
+
+# Cache for downloaded video inputs, keyed by URL hash.
+# Opt-in: a cached entry is served for as long as it survives eviction, so
+# only enable this when video URLs always point at the same bytes.
+CACHE_VIDEO_INPUTS = os.environ.get('CACHE_VIDEO_INPUTS', '').lower() in ('1', 'true', 'yes')
+VIDEO_CACHE_DIR = '/tmp/video_cache'
+VIDEO_CACHE_MAX_BYTES = int(os.environ.get('VIDEO_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+VIDEO_CACHE_STALE_AGE = 3600  # seconds before an untouched .part or .lock counts as abandoned
+os.makedirs(VIDEO_CACHE_DIR, exist_ok=True)
+
+# Opt-in: put the narration download on RAM-backed /dev/shm when it has at
+# least this much free space. Video inputs stay on disk next to the video
+# cache so cache hits remain hardlinks, and so do the caches and OUTPUT_DIR.
+USE_SHM_FOR_AUDIO = os.environ.get('USE_SHM_FOR_AUDIO', '').lower() in ('1', 'true', 'yes')
+AUDIO_SHM_MIN_FREE = 512 * 1024 * 1024
+
+# Let clients and CDNs cache combined videos for an hour
+DOWNLOAD_MAX_AGE = 3600
+
+# Shared HTTP session so downloads reuse keep-alive connections and TLS sessions
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=10,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        respect_retry_after_header=False  # A long Retry-After would park the request thread
+    )
+))
+# Never keep cookies, so one caller's download can't leak state into another's
+SESSION.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+
+def find_ffmpeg():
+    """Locate a working FFmpeg binary"""
+    ffmpeg_commands = [
+        'ffmpeg',
+        '/usr/bin/ffmpeg',
+        '/usr/local/bin/ffmpeg'
+    ]
+    
+    for cmd in ffmpeg_commands:
+        try:
+            result = subprocess.run([cmd, '-version'], capture_output=True, text=True, timeout=5)
+            if result.returncode == 0:
+                return cmd
+        except:
+            continue
+    
+    return None
+
+# Resolve FFmpeg once at startup instead of probing on every request
+FFMPEG_PATH = find_ffmpeg()
+print(f"FFmpeg binary: {FFMPEG_PATH}")
+
+FFMPEG_TIMEOUT = 300  # seconds
+
+def find_ffprobe():
+    """Locate the ffprobe binary shipped alongside FFmpeg"""
+    if not FFMPEG_PATH:
+        return None
+    
+    cmd = os.path.join(os.path.dirname(FFMPEG_PATH), 'ffprobe')
+    try:
+        result = subprocess.run([cmd, '-version'], capture_output=True, text=True, timeout=5)
+        if result.returncode == 0:
+            return cmd
+    except:
+        pass
+    
+    return None
+
+FFPROBE_PATH = find_ffprobe()
+print(f"FFprobe binary: {FFPROBE_PATH}")
 
 def check_ffmpeg():
     """Check if FFmpeg is available"""
+    return FFMPEG_PATH is not None
+
+def pick_audio_dir():
+    """Use RAM-backed /dev/shm for the audio input when enabled and it has room, else /tmp"""
+    if not USE_SHM_FOR_AUDIO:
+        return '/tmp'
+    
     try:
-        result = subprocess.run(['which', 'ffmpeg'], capture_output=True, text=True)
-        return result.returncode == 0
-    except:
-        return False
+        if shutil.disk_usage('/dev/shm').free >= AUDIO_SHM_MIN_FREE:
+            return '/dev/shm'
+    except OSError:
+        pass
+    return '/tmp'
+
+def remove_files(*paths):
+    """Remove files, ignoring any that are already gone"""
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
 
 def download_file(url, filename):
     """Download file from URL with enhanced headers for Dropbox compatibility"""
@@ -46,52 +152,50 @@ def download_file(url, filename):
         is_dropbox_temp = 'dropboxusercontent.com' in url
         print(f"Dropbox temporary link detected: {is_dropbox_temp}")
         
-        response = requests.get(
+        # Closing the response on every path hands the connection back to the pool
+        with SESSION.get(
             url, 
             headers=headers, 
             stream=True, 
             timeout=60,  # Increased timeout for audio files
             allow_redirects=True,
             verify=True  # Ensure SSL verification
-        )
-        
-        print(f"Response status: {response.status_code}")
-        print(f"Response headers: {dict(response.headers)}")
-        print(f"Final URL after redirects: {response.url}")
-        
-        response.raise_for_status()
-        
-        # Check content type for audio files
-        content_type = response.headers.get('content-type', '').lower()
-        print(f"Content-Type: {content_type}")
-        
-        if 'audio' in filename and 'audio' not in content_type and 'octet-stream' not in content_type:
-            print(f"Warning: Expected audio content but got {content_type}")
-        
-        # Write file in chunks
-        total_size = 0
-        with open(filename, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:  # Filter out keep-alive chunks
-                    f.write(chunk)
-                    total_size += len(chunk)
-        
-        file_size = os.path.getsize(filename)
-        print(f"Downloaded {file_size} bytes to {filename}")
-        print(f"Total streamed: {total_size} bytes")
-        
-        # Verify file size
-        if file_size == 0:
-            print("Error: Downloaded file is empty")
-            return False
+        ) as response:
+            print(f"Response status: {response.status_code}")
+            print(f"Response headers: {dict(response.headers)}")
+            print(f"Final URL after redirects: {response.url}")
+            
+            response.raise_for_status()
+            
+            # Check content type for audio files
+            content_type = response.headers.get('content-type', '').lower()
+            print(f"Content-Type: {content_type}")
             
-        # For audio files, do additional verification
-        if 'audio' in filename:
-            if file_size < 1000:  # Less than 1KB is suspicious for audio
-                print(f"Warning: Audio file seems too small ({file_size} bytes)")
+            if 'audio' in filename and 'audio' not in content_type and 'octet-stream' not in content_type:
+                print(f"Warning: Expected audio content but got {content_type}")
+            
+            # Copy the raw stream to disk in 1 MiB blocks, decoding any gzip/br on the way
+            response.raw.decode_content = True
+            with open(filename, 'wb') as f:
+                shutil.copyfileobj(response.raw, f, length=1024 * 1024)
+                total_size = f.tell()
+            
+            file_size = os.path.getsize(filename)
+            print(f"Downloaded {file_size} bytes to {filename}")
+            print(f"Total streamed: {total_size} bytes")
+            
+            # Verify file size
+            if file_size == 0:
+                print("Error: Downloaded file is empty")
                 return False
-        
-        return True
+            
+            # For audio files, do additional verification
+            if 'audio' in filename:
+                if file_size < 1000:  # Less than 1KB is suspicious for audio
+                    print(f"Warning: Audio file seems too small ({file_size} bytes)")
+                    return False
+            
+            return True
         
     except requests.exceptions.Timeout as e:
         print(f"Timeout error downloading {url}: {e}")
@@ -109,8 +213,161 @@ def download_file(url, filename):
         print(f"General error downloading {url}: {e}")
         return False
 
+def remove_stale_temp(path, cutoff):
+    """Remove a .part or .lock file untouched since cutoff, left by a killed worker"""
+    try:
+        if os.stat(path).st_mtime >= cutoff:
+            return
+        
+        if path.endswith('.lock'):
+            # Take the lock the way a fill would, so a slow fill keeps its file
+            with open(path, 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                if os.stat(path).st_ino != os.fstat(lock_file.fileno()).st_ino:
+                    return
+                os.remove(path)
+        else:
+            os.remove(path)
+        print(f"Removed stale {path}")
+    except OSError:
+        pass
+
+def prune_cache(directory, max_bytes, keep=None, stale_after=None):
+    """Delete least recently used files until the directory fits in max_bytes"""
+    cutoff = time.time() - stale_after if stale_after is not None else None
+    entries = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.endswith(('.part', '.lock')):
+            # Still being written or guarding a fill, unless its worker died long ago
+            if cutoff is not None:
+                remove_stale_temp(path, cutoff)
+            continue
+        if path == keep:
+            continue  # Just filled and about to be used
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_atime, stat.st_size, path))
+    
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total_size -= size
+            print(f"Evicted {path} from cache ({size} bytes)")
+        except OSError:
+            pass
+
+def prune_outputs_forever():
+    """Periodically evict old combined videos so OUTPUT_DIR stays bounded"""
+    while True:
+        try:
+            # FFmpeg is killed after FFMPEG_TIMEOUT, so older .part files are orphans
+            prune_cache(OUTPUT_DIR, OUTPUT_CACHE_MAX_BYTES, stale_after=2 * FFMPEG_TIMEOUT)
+        except Exception as e:
+            print(f"Error pruning {OUTPUT_DIR}: {e}")
+        time.sleep(OUTPUT_PRUNE_INTERVAL)
+
+threading.Thread(target=prune_outputs_forever, daemon=True).start()
+
+def cached_download(url, filename):
+    """Download file via the on-disk cache so repeated video URLs are fetched once"""
+    if not CACHE_VIDEO_INPUTS:
+        return download_file(url, filename)
+    
+    # Dropbox temporary links are issued per request and expire after a few
+    # hours, so a cached copy would never be hit again
+    if 'dropboxusercontent.com' in url:
+        return download_file(url, filename)
+    
+    key = hashlib.blake2b(url.encode(), digest_size=16).hexdigest()
+    cache_path = os.path.join(VIDEO_CACHE_DIR, f'{key}.mp4')
+    
+    if os.path.exists(cache_path):
+        print(f"Cache hit for {url}: {cache_path}")
+        try:
+            os.utime(cache_path)  # Mark as recently used for eviction
+        except OSError:
+            pass
+    else:
+        # Serialize fills of the same URL across threads and gunicorn workers
+        lock_path = f'{cache_path}.lock'
+        while True:
+            lock_file = open(lock_path, 'a')
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # The previous holder may have removed the file while we waited,
+            # so only trust the lock if it is still the file at lock_path
+            try:
+                if os.stat(lock_path).st_ino == os.fstat(lock_file.fileno()).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            lock_file.close()
+        
+        with lock_file:
+            try:
+                if os.path.exists(cache_path):
+                    print(f"Cache filled by another request for {url}: {cache_path}")
+                else:
+                    print(f"Cache miss for {url}")
+                    # Download next to the cache entry and rename so readers never see a partial file
+                    part_path = f'{cache_path}.{uuid.uuid4().hex}.part'
+                    if not download_file(url, part_path):
+                        remove_files(part_path)
+                        return False
+                    os.replace(part_path, cache_path)
+                    prune_cache(VIDEO_CACHE_DIR, VIDEO_CACHE_MAX_BYTES, keep=cache_path,
+                                stale_after=VIDEO_CACHE_STALE_AGE)
+            finally:
+                # Drop the lock file once the fill is settled so they don't pile up.
+                # Only the holder of the current file ever removes it, and waiters
+                # on the removed file retry on a fresh one.
+                remove_files(lock_path)
+    
+    try:
+        os.link(cache_path, filename)
+    except OSError:
+        try:
+            shutil.copyfile(cache_path, filename)
+        except OSError as e:
+            # Entry was evicted by a concurrent fill, fetch it directly instead
+            print(f"Cache entry unavailable for {url}: {e}")
+            return download_file(url, filename)
+    
+    return True
+
+def get_audio_codec(path):
+    """Return the codec of the first audio stream, or None if it can't be probed"""
+    if not FFPROBE_PATH:
+        return None
+    
+    try:
+        result = subprocess.run([
+            FFPROBE_PATH,
+            '-v', 'error',
+            '-select_streams', 'a:0',
+            '-show_entries', 'stream=codec_name',
+            '-of', 'csv=p=0',
+            path
+        ], capture_output=True, text=True, timeout=10)
+        if result.returncode == 0:
+            return result.stdout.strip() or None
+        print(f"FFprobe error: {result.stderr}")
+    except Exception as e:
+        print(f"FFprobe exception: {e}")
+    
+    return None
+
 def combine_audio_video(audio_path, video_path, output_path):
     """Combine audio and video using FFmpeg"""
+    # FFmpeg writes to a temporary name that is renamed into place on success,
+    # so /download never serves a half-written file
+    part_path = f'{output_path}.{uuid.uuid4().hex}.part'
+    
     try:
         # Verify input files exist and have content
         if not os.path.exists(audio_path):
@@ -135,47 +392,38 @@ def combine_audio_video(audio_path, video_path, output_path):
             print("Error: Video file is empty")
             return False
         
-        # Try different FFmpeg commands
-        ffmpeg_commands = [
-            'ffmpeg',
-            '/usr/bin/ffmpeg',
-            '/usr/local/bin/ffmpeg'
-        ]
-        
-        ffmpeg_path = None
-        for cmd in ffmpeg_commands:
-            try:
-                result = subprocess.run([cmd, '-version'], capture_output=True, text=True, timeout=5)
-                if result.returncode == 0:
-                    ffmpeg_path = cmd
-                    break
-            except:
-                continue
-        
-        if not ffmpeg_path:
+        if not FFMPEG_PATH:
             print("FFmpeg not found")
             return False
         
+        # AAC narration can go into the MP4 untouched, anything else is encoded
+        audio_codec = get_audio_codec(audio_path)
+        print(f"Audio codec: {audio_codec}")
+        audio_codec_args = ['-c:a', 'copy'] if audio_codec == 'aac' else ['-c:a', 'aac']
+        
         # UPDATED cmd ARRAY:
         cmd = [
-            ffmpeg_path,
+            FFMPEG_PATH,
             '-i', video_path,
             '-i', audio_path,
             '-map', '0:v',      # Only take video from input 0 (strips native audio)
             '-map', '1:a',      # Only take audio from input 1 (your new audio)
             '-c:v', 'copy',
-            '-c:a', 'aac',
+            *audio_codec_args,
             '-shortest',
+            '-movflags', '+faststart',  # Put the moov atom first so players can start before the download ends
+            '-f', 'mp4',  # Format can't be inferred from the .part extension
             '-y',  # Overwrite output file
-            output_path
+            part_path
         ]
         
         
         print(f"Running FFmpeg command: {' '.join(cmd)}")
         
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=FFMPEG_TIMEOUT)
         
         if result.returncode == 0:
+            os.replace(part_path, output_path)
             output_size = os.path.getsize(output_path)
             print(f"FFmpeg success. Output file size: {output_size} bytes")
             return True
@@ -190,6 +438,59 @@ def combine_audio_video(audio_path, video_path, output_path):
     except Exception as e:
         print(f"FFmpeg exception: {e}")
         return False
+    finally:
+        remove_files(part_path)
+
+def build_output(audio_url, video_url, rebuild=False):
+    """Download and combine the inputs, reusing an earlier output when enabled
+
+    Returns (job_id, output_path, None), or (None, None, error_response) on failure.
+    """
+    if REUSE_OUTPUTS:
+        # Inputs are declared immutable, so key jobs by URL
+        job_id = hashlib.sha256(f'{audio_url}|{video_url}'.encode()).hexdigest()[:16]
+    else:
+        # Generate unique filename
+        job_id = str(uuid.uuid4())
+    output_path = f'{OUTPUT_DIR}/combined_{job_id}.mp4'
+    
+    if REUSE_OUTPUTS and not rebuild:
+        try:
+            os.utime(output_path)  # Mark as recently used for eviction
+            print(f"=== CACHE HIT: {output_path} ===")
+            return job_id, output_path, None
+        except OSError:
+            pass  # Not built yet, or already evicted by the prune thread
+    
+    # Input names stay unique so concurrent identical jobs don't collide
+    input_id = uuid.uuid4().hex
+    audio_path = f'{pick_audio_dir()}/audio_{input_id}.mp3'
+    video_path = f'/tmp/video_{input_id}.mp4'
+    
+    try:
+        # Download audio and video concurrently
+        print(f"=== DOWNLOADING AUDIO AND VIDEO ===")
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            audio_future = executor.submit(download_file, audio_url, audio_path)
+            video_future = executor.submit(cached_download, video_url, video_path)
+            audio_ok = audio_future.result()
+            video_ok = video_future.result()
+        
+        if not audio_ok:
+            return None, None, (jsonify({"error": "Failed to download audio"}), 400)
+        
+        if not video_ok:
+            return None, None, (jsonify({"error": "Failed to download video"}), 400)
+        
+        # Combine with FFmpeg
+        print(f"=== COMBINING FILES ===")
+        if not combine_audio_video(audio_path, video_path, output_path):
+            return None, None, (jsonify({"error": "Failed to combine audio and video"}), 500)
+    finally:
+        # Audio may sit in RAM-backed /dev/shm, so never leave inputs behind
+        remove_files(audio_path, video_path)
+    
+    return job_id, output_path, None
 
 @app.route('/health', methods=['GET'])
 def health():
@@ -218,42 +519,29 @@ def combine_videos():
         print(f"Audio URL: {audio_url}")
         print(f"Video URL: {video_url}")
         
-        # Generate unique filename
-        job_id = str(uuid.uuid4())
-        
-        # File paths
-        audio_path = f'/tmp/audio_{job_id}.mp3'
-        video_path = f'/tmp/video_{job_id}.mp4'
-        output_path = f'{OUTPUT_DIR}/combined_{job_id}.mp4'
-        
-        # Download files
-        print(f"=== DOWNLOADING AUDIO ===")
-        if not download_file(audio_url, audio_path):
-            return jsonify({"error": "Failed to download audio"}), 400
-            
-        print(f"=== DOWNLOADING VIDEO ===")
-        if not download_file(video_url, video_path):
-            return jsonify({"error": "Failed to download video"}), 400
-        
-        # Combine with FFmpeg
-        print(f"=== COMBINING FILES ===")
-        if not combine_audio_video(audio_path, video_path, output_path):
-            return jsonify({"error": "Failed to combine audio and video"}), 500
-        
-        # Clean up input files
-        try:
-            os.remove(audio_path)
-            os.remove(video_path)
-        except:
-            pass
+        job_id, output_path, error = build_output(audio_url, video_url)
+        if error:
+            return error
         
         # Return the combined video file
-        return send_file(
-            output_path,
-            as_attachment=True,
-            download_name=f'combined_{job_id}.mp4',
-            mimetype='video/mp4'
-        )
+        try:
+            return send_file(
+                output_path,
+                as_attachment=True,
+                download_name=f'combined_{job_id}.mp4',
+                mimetype='video/mp4'
+            )
+        except FileNotFoundError:
+            # Evicted right after a reuse hit, so build it once more
+            job_id, output_path, error = build_output(audio_url, video_url, rebuild=True)
+            if error:
+                return error
+            return send_file(
+                output_path,
+                as_attachment=True,
+                download_name=f'combined_{job_id}.mp4',
+                mimetype='video/mp4'
+            )
         
     except Exception as e:
         print(f"Error in combine_videos: {e}")
@@ -278,38 +566,20 @@ def combine_videos_url():
         print(f"Audio URL: {audio_url}")
         print(f"Video URL: {video_url}")
         
-        # Generate unique filename
-        job_id = str(uuid.uuid4())
-        
-        # File paths
-        audio_path = f'/tmp/audio_{job_id}.mp3'
-        video_path = f'/tmp/video_{job_id}.mp4'
-        output_path = f'{OUTPUT_DIR}/combined_{job_id}.mp4'
-        
-        # Download files
-        print(f"=== DOWNLOADING AUDIO ===")
-        if not download_file(audio_url, audio_path):
-            return jsonify({"error": "Failed to download audio"}), 400
-            
-        print(f"=== DOWNLOADING VIDEO ===")
-        if not download_file(video_url, video_path):
-            return jsonify({"error": "Failed to download video"}), 400
-        
-        # Combine with FFmpeg
-        print(f"=== COMBINING FILES ===")
-        if not combine_audio_video(audio_path, video_path, output_path):
-            return jsonify({"error": "Failed to combine audio and video"}), 500
-        
-        # Clean up input files
-        try:
-            os.remove(audio_path)
-            os.remove(video_path)
-        except:
-            pass
+        job_id, output_path, error = build_output(audio_url, video_url)
+        if error:
+            return error
         
         # Return URL info instead of file - now with .mp4 extension for Creatomate
+        try:
+            file_size = os.path.getsize(output_path)
+        except FileNotFoundError:
+            # Evicted right after a reuse hit, so build it once more
+            job_id, output_path, error = build_output(audio_url, video_url, rebuild=True)
+            if error:
+                return error
+            file_size = os.path.getsize(output_path)
         download_url = f"{request.host_url}download/{job_id}.mp4"
-        file_size = os.path.getsize(output_path)
         
         print(f"=== SUCCESS ===")
         print(f"Download URL: {download_url}")
@@ -335,16 +605,16 @@ def download_video(job_id):
     if not os.path.exists(output_path):
         return jsonify({"error": "File not found"}), 404
     
+    # Conditional responses handle Range/If-None-Match, and the file body goes
+    # through the WSGI file wrapper so gunicorn can use sendfile
     response = send_file(
         output_path,
         as_attachment=False,
-        mimetype='video/mp4'
+        mimetype='video/mp4',
+        conditional=True,
+        max_age=DOWNLOAD_MAX_AGE
     )
     
-    # Add headers for better video streaming
-    response.headers['Accept-Ranges'] = 'bytes'
-    response.headers['Content-Type'] = 'video/mp4'
-    
     return response
 
 @app.route('/download/<job_id>.mp4', methods=['GET'])
@@ -355,17 +625,16 @@ def download_video_mp4(job_id):
     if not os.path.exists(output_path):
         return jsonify({"error": "File not found"}), 404
     
+    # Conditional responses handle Range/If-None-Match, and the file body goes
+    # through the WSGI file wrapper so gunicorn can use sendfile
     response = send_file(
         output_path,
         as_attachment=False,
-        mimetype='video/mp4'
+        mimetype='video/mp4',
+        conditional=True,
+        max_age=DOWNLOAD_MAX_AGE
     )
     
-    # Add headers for better video streaming and Creatomate compatibility
-    response.headers['Accept-Ranges'] = 'bytes'
-    response.headers['Content-Type'] = 'video/mp4'
-    response.headers['Cache-Control'] = 'public, max-age=3600'
-    
     return response
 
 if __name__ == '__main__':